@@ -1,40 +1,601 @@
-import io
+import atexit
+import functools
+import hashlib
+import json
 import os
 import shutil
+import signal
+import socket
 import subprocess
 import tempfile
+import threading
+import time
+import uuid
 import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, suppress
 from datetime import datetime
+from itertools import repeat
 
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Request, Response, after_this_request, request, send_file, jsonify, url_for
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
 import fitz  # PyMuPDF
 from pdf2docx import Converter
-from PyPDF2 import PdfReader, PdfWriter
 import pikepdf
-import img2pdf
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
+from pikepdf import Name
+
+# Scratch space for uploads and intermediates. Point PDF_TMPDIR at a tmpfs
+# (e.g. /dev/shm/pdfjobs) to keep it in RAM where the container allows it.
+if os.environ.get("PDF_TMPDIR"):
+    tempfile.tempdir = os.environ["PDF_TMPDIR"]
+    os.makedirs(tempfile.tempdir, exist_ok=True)
+
+
+class DiskRequest(Request):
+    # Spool every uploaded file straight to disk; Werkzeug's default keeps
+    # anything under 500KB in memory and large PDFs in a SpooledTemporaryFile.
+    # The spool file is named so views can hard-link it into their job
+    # directory (see _link_upload) instead of copying it a second time.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile("wb+", prefix="upload-")
+
 
 app = Flask(__name__)
+app.request_class = DiskRequest
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_MB", 100)) * 1024 * 1024
 CORS(app)
 
-ALLOWED_PDF = {"application/pdf", ".pdf"}
-ALLOWED_DOC = {"application/vnd.openxmlformats-officedocument.wordprocessingml.document", ".docx"}
-ALLOWED_IMG = {"image/jpeg", ".jpg", ".jpeg"}
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Leading bytes of each accepted upload type; the client-supplied mimetype isn't trusted
+PDF_MAGIC = b"%PDF-"
+ZIP_MAGIC = b"PK\x03\x04"
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Pages per pdf_to_jpg worker task
+RENDER_BATCH = 8
+JPG_QUALITY = 85
+# Largest pixmap pdf_to_jpg renders (~100MB of RGB at the default); pages that
+# would exceed it at the requested dpi are scaled down to fit
+MAX_RENDER_PIXELS = int(os.environ.get("MAX_RENDER_PIXELS", 36_000_000))
+
+# JPEG start-of-frame markers (SOF0-SOF15 minus DHT/JPG/DAC) and EXIF orientation -> /Rotate
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_COLORSPACE = {1: Name.DeviceGray, 3: Name.DeviceRGB, 4: Name.DeviceCMYK}
+EXIF_ROTATE = {1: 0, 3: 180, 6: 90, 8: 270}
+
+# Page numbers: 10pt Helvetica, 0.8in from the right edge and 0.5in from the bottom
+NUMBER_FONT_SIZE = 10
+NUMBER_OFFSET = (0.8 * 72, 0.5 * 72)
+
+# External converters, resolved once at import; None when not installed
+GS_BIN = shutil.which("gs")
+SOFFICE_BIN = shutil.which("soffice")
+UNOSERVER_BIN = shutil.which("unoserver")
+UNOCONVERT_BIN = shutil.which("unoconvert")
+
+# Ghostscript is single-threaded; cap how many run at once in each worker
+# and queue the rest instead of oversubscribing the CPU.
+GS_POOL_SIZE = int(os.environ.get("GS_POOL_SIZE", 2))
+gs_pool = ThreadPoolExecutor(max_workers=GS_POOL_SIZE, thread_name_prefix="gs")
+# Below this size gs startup costs more than it saves; pikepdf handles it alone
+GS_MIN_BYTES = int(os.environ.get("GS_MIN_BYTES", 100 * 1024))
+
+# Recently parsed uploads, keyed by (sha256, size). Users often run several
+# tools on the same file; each worker keeps a few parsed documents around.
+PDF_CACHE_SIZE = int(os.environ.get("PDF_CACHE_SIZE", 4))
+_pdf_cache = OrderedDict()
+_pdf_cache_lock = threading.Lock()
+
+# One long-lived unoserver (and the LibreOffice it drives) per worker process,
+# started from gunicorn's post_fork hook; maps pid -> (process, XML-RPC port, start time)
+_soffice_lock = threading.Lock()
+_soffice_procs = {}
+# A server that died is restarted at most this often, so a broken install
+# doesn't spawn a LibreOffice per request
+SOFFICE_RESTART_DELAY = 60
+# Upper bound on any single LibreOffice conversion
+SOFFICE_TIMEOUT = int(os.environ.get("SOFFICE_TIMEOUT", 120))
+
+# Slow conversions can run detached: with ?async=1 the view returns a job id
+# to poll instead of the file. Job state lives on disk, so whichever gunicorn
+# worker gets the poll can answer it; finished jobs are swept after JOB_TTL.
+JOBS_DIR = os.path.join(tempfile.gettempdir(), "pdfjobs")
+JOB_POOL_SIZE = int(os.environ.get("JOB_POOL_SIZE", 2))
+JOB_TTL = int(os.environ.get("JOB_TTL", 3600))
+job_pool = ThreadPoolExecutor(max_workers=JOB_POOL_SIZE, thread_name_prefix="job")
+
+
+def _sniff(file_storage):
+    head = file_storage.stream.read(8)
+    file_storage.stream.seek(0)
+    return head
+
+
+def _is_pdf(file_storage):
+    return _sniff(file_storage).startswith(PDF_MAGIC)
+
+
+def _is_docx(file_storage):
+    # A docx is a zip container; the extension tells it apart from xlsx/odt/etc.
+    return _sniff(file_storage).startswith(ZIP_MAGIC) and (file_storage.filename or "").lower().endswith(".docx")
+
 
+def _is_jpeg(file_storage):
+    return _sniff(file_storage).startswith(JPEG_MAGIC)
 
-def _is_type(file_storage, allowed):
-    filename = file_storage.filename.lower()
-    ctype = file_storage.mimetype.lower() if file_storage.mimetype else ""
-    return any(x in filename for x in allowed) or any(x in ctype for x in allowed)
 
+def _job_dir():
+    # Scratch directory for one request, removed as soon as the response is
+    # built. send_file has already opened the output by then, and an unlinked
+    # file stays readable until the response closes it.
+    td = tempfile.mkdtemp(prefix="pdfjob-")
 
-def _send_bytes(byte_data: bytes, filename: str, mimetype: str):
-    return send_file(io.BytesIO(byte_data), as_attachment=True, download_name=filename, mimetype=mimetype)
+    @after_this_request
+    def _cleanup(response):
+        shutil.rmtree(td, ignore_errors=True)
+        return response
+
+    return td
+
+
+def _send_path(path, filename, mimetype):
+    # A real path lets the WSGI server use wsgi.file_wrapper (sendfile(2) under gunicorn)
+    return send_file(path, as_attachment=True, download_name=filename, mimetype=mimetype)
+
+
+class _ZipSink:
+    # Write-only buffer for zipfile. With no tell()/seek() zipfile switches to
+    # data descriptors, so the archive can be sent entry by entry as it's built.
+    def __init__(self):
+        self._buf = bytearray()
+
+    def write(self, data):
+        self._buf += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+
+def _bounded_map(ex, fn, items, window, *args):
+    # Like ex.map(fn, *args, item) but with at most `window` tasks in flight,
+    # so results a slow consumer hasn't taken yet don't pile up in memory
+    pending = deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(ex.submit(fn, *args, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Client went away mid-download: drop work that hasn't started
+        for fut in pending:
+            fut.cancel()
+
+
+def _save_pdf(pdf, path, **kwargs):
+    # Pack objects into compressed object streams; QPDF rewrites the xref natively
+    pdf.save(path, object_stream_mode=pikepdf.ObjectStreamMode.generate, **kwargs)
+
+
+def _link_upload(f, path):
+    # The spooled upload lives under the same tempdir as the job directory, so
+    # give it a second name there; its own name goes away when the request ends
+    try:
+        f.stream.flush()
+        os.link(f.stream.name, path)
+    except (AttributeError, OSError):
+        f.save(path)
+
+
+def _save_upload(f, path):
+    # Put the upload at path and hash it; returns the cache key
+    _link_upload(f, path)
+    sha = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(64 * 1024), b""):
+            sha.update(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), size
+
+
+def _checkout_pdf(path, key):
+    # A cached document is removed while in use: QPDF objects are not thread-safe,
+    # so concurrent requests for the same upload each get their own copy
+    with _pdf_cache_lock:
+        pdf = _pdf_cache.pop(key, None)
+    return pdf if pdf is not None else pikepdf.open(path)
+
+
+def _checkin_pdf(key, pdf):
+    with _pdf_cache_lock:
+        stale = [_pdf_cache.pop(key, None)]
+        _pdf_cache[key] = pdf
+        while len(_pdf_cache) > PDF_CACHE_SIZE:
+            stale.append(_pdf_cache.popitem(last=False)[1])
+    for old in stale:
+        if old is not None:
+            old.close()
+
+
+@contextmanager
+def _checked_out(key, pdf):
+    # Return pdf to the cache only if the handler finished; one that was in use
+    # when something failed may be left in a bad state, so close it instead
+    try:
+        yield pdf
+    except BaseException:
+        pdf.close()
+        raise
+    _checkin_pdf(key, pdf)
+
+
+def _cached_pdf(path, key):
+    # Only for handlers that read the document; anything that edits pages opens its own
+    return _checked_out(key, _checkout_pdf(path, key))
+
+
+def _parse_ranges(spec, maxn):
+    # "5,1-3,2-4" -> ((1, 4), (5, 5)): sorted, merged, inclusive 1-based
+    # intervals clamped to 1..maxn; cost depends on the spec, not the page count
+    ranges = []
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        a, _, b = part.partition("-")
+        lo, hi = max(1, int(a)), min(maxn, int(b or a))
+        if lo <= hi:
+            ranges.append((lo, hi))
+    ranges.sort()
+    merged = []
+    for lo, hi in ranges:
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return tuple(merged)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _soffice_pidfile(pid):
+    return os.path.join(tempfile.gettempdir(), f"unoserver-{pid}.pid")
+
+
+def _soffice_profile(pid):
+    return os.path.join(tempfile.gettempdir(), f"lo-profile-{pid}")
+
+
+def _ensure_soffice():
+    # Start (or restart) this worker's unoserver without waiting for it to come
+    # up; returns its port. Keyed by pid so forked workers each get their own.
+    if not (UNOSERVER_BIN and SOFFICE_BIN):
+        return None
+    with _soffice_lock:
+        entry = _soffice_procs.get(os.getpid())
+        if entry is None or (entry[0].poll() is not None and time.monotonic() - entry[2] > SOFFICE_RESTART_DELAY):
+            profile = _soffice_profile(os.getpid())
+            port = _free_port()
+            # Own session, so _kill_soffice can take LibreOffice down with it
+            proc = subprocess.Popen(
+                [UNOSERVER_BIN, "--interface", "127.0.0.1", "--port", str(port), "--uno-port", str(_free_port()),
+                 "--executable", SOFFICE_BIN, "--user-installation", profile],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+            )
+            with open(_soffice_pidfile(os.getpid()), "w") as fh:
+                fh.write(str(proc.pid))
+            entry = _soffice_procs[os.getpid()] = (proc, port, time.monotonic())
+        return entry[1]
+
+
+def _soffice_ready(port):
+    # unoserver binds its port ~10s after launch and unoconvert retries a refused
+    # connection for ~40s, so only hand work over once something is listening
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def _kill_soffice(pid):
+    # Stop worker pid's unoserver and its LibreOffice and remove its profile. Also
+    # called from gunicorn's child_exit hook in the master, since a worker killed
+    # on timeout skips atexit.
+    pidfile = _soffice_pidfile(pid)
+    try:
+        with open(pidfile) as fh:
+            os.killpg(int(fh.read()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+    with suppress(OSError):
+        os.remove(pidfile)
+    shutil.rmtree(_soffice_profile(pid), ignore_errors=True)
+
+
+@atexit.register
+def _stop_soffice():
+    if _soffice_procs.pop(os.getpid(), None) is not None:
+        _kill_soffice(os.getpid())
+
+
+def _soffice_convert(in_path, out_dir, fmt, infilter=None):
+    # Hand the job to the warm unoserver; fall back to a one-shot soffice when
+    # unoserver is missing, not listening yet, or fails.
+    out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(in_path))[0] + "." + fmt)
+    if UNOCONVERT_BIN:
+        port = _ensure_soffice()
+        if port is not None and _soffice_ready(port):
+            cmd = [UNOCONVERT_BIN, "--host", "127.0.0.1", "--port", str(port), "--convert-to", fmt]
+            if infilter:
+                cmd += ["--input-filter", infilter]
+            try:
+                subprocess.check_call(cmd + [in_path, out_path], timeout=SOFFICE_TIMEOUT)
+                return out_path
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                pass
+    # A private profile per call: runs sharing the default one contend for its
+    # lock and single-instance pipe, and the loser can exit without any output
+    profile = os.path.join(out_dir, "lo-profile")
+    cmd = [SOFFICE_BIN, "--headless", f"-env:UserInstallation=file://{profile}"]
+    if infilter:
+        cmd.append(f"--infilter={infilter}")
+    subprocess.check_call(cmd + ["--convert-to", fmt, "--outdir", out_dir, in_path], timeout=SOFFICE_TIMEOUT)
+    return out_path
+
+
+def _run_gs(inp, outp, preset):
+    gs_preset = {"screen": "/screen", "ebook": "/ebook", "printer": "/printer"}.get(preset, "/ebook")
+    cmd = [
+        GS_BIN, "-sDEVICE=pdfwrite", "-dCompatibilityLevel=1.5",
+        f"-dPDFSETTINGS={gs_preset}", "-dNOPAUSE", "-dQUIET", "-dBATCH",
+        "-dDetectDuplicateImages=true", "-dCompressFonts=true", "-dSubsetFonts=true",
+        f"-sOutputFile={outp}", inp
+    ]
+    subprocess.check_call(cmd)
+    return outp
+
+
+def _exif_info(seg):
+    # seg is an APP1 payload starting with b"Exif\0\0"; returns the IFD0 Orientation
+    # (default 1) and the resolution from XResolution/ResolutionUnit. Like PIL,
+    # which img2pdf relied on, EXIF without both resolution tags means 72 dpi.
+    tiff = seg[6:]
+    order = "little" if tiff[:2] == b"II" else "big"
+    ifd = int.from_bytes(tiff[4:8], order)
+    tags = {}
+    for n in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+        entry = tiff[ifd + 2 + 12 * n:ifd + 14 + 12 * n]
+        tags[int.from_bytes(entry[:2], order)] = entry
+    orientation = int.from_bytes(tags[0x0112][8:10], order) if 0x0112 in tags else 1
+    dpi = 72.0
+    if 0x011A in tags and 0x0128 in tags:
+        off = int.from_bytes(tags[0x011A][8:12], order)
+        num, den = int.from_bytes(tiff[off:off + 4], order), int.from_bytes(tiff[off + 4:off + 8], order)
+        if den:
+            dpi = num / den * (2.54 if int.from_bytes(tags[0x0128][8:10], order) == 3 else 1)
+    return orientation, dpi
+
+
+def _jpeg_info(data: bytes):
+    # Walk marker segments up to the first SOFn: (width, height, components, dpi, orientation)
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG")
+    # The JFIF density wins when it has a unit; then EXIF resolution; then 96 dpi.
+    # img2pdf rounded to whole dpi, so this does too.
+    jfif_dpi, exif_dpi, orientation, i = None, None, 1, 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            raise ValueError("malformed JPEG")
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        seglen = int.from_bytes(data[i + 2:i + 4], "big")
+        seg = data[i + 4:i + 2 + seglen]
+        if marker == 0xE0 and seg[:5] == b"JFIF\0" and seg[7] in (1, 2):
+            density = int.from_bytes(seg[8:10], "big")
+            if density:
+                jfif_dpi = density if seg[7] == 1 else density * 2.54
+        elif marker == 0xE1 and seg[:6] == b"Exif\0\0":
+            orientation, exif_dpi = _exif_info(seg)
+        elif marker in JPEG_SOF:
+            # Pages are written with BitsPerComponent 8; 12-bit JPEGs would come out broken
+            if seg[0] != 8:
+                raise ValueError("unsupported JPEG")
+            height = int.from_bytes(seg[1:3], "big")
+            width = int.from_bytes(seg[3:5], "big")
+            return width, height, seg[5], round(jfif_dpi or exif_dpi or 96) or 96, orientation
+        i += 2 + seglen
+    raise ValueError("no SOF marker in JPEG")
+
+
+def _add_jpeg_page(pdf, data: bytes):
+    # Embed the JPEG bitstream as-is (/DCTDecode) on a page sized to the image
+    width, height, components, dpi, orientation = _jpeg_info(data)
+    if components not in JPEG_COLORSPACE or orientation not in EXIF_ROTATE:
+        raise ValueError("unsupported JPEG")
+    image = pikepdf.Stream(
+        pdf, data, Type=Name.XObject, Subtype=Name.Image, Width=width, Height=height,
+        ColorSpace=JPEG_COLORSPACE[components], BitsPerComponent=8, Filter=Name.DCTDecode,
+    )
+    if components == 4:
+        # Adobe writes CMYK JPEGs inverted
+        image.Decode = [1, 0] * 4
+    w, h = width * 72 / dpi, height * 72 / dpi
+    page = pdf.add_blank_page(page_size=(w, h))
+    page.Resources.XObject = pikepdf.Dictionary(Im0=image)
+    page.Contents = pikepdf.Stream(pdf, f"q {w:.4f} 0 0 {h:.4f} 0 0 cm /Im0 Do Q".encode())
+    if EXIF_ROTATE[orientation]:
+        page.Rotate = EXIF_ROTATE[orientation]
+
+
+def _parse_docx_pages(pdf_path, page_indexes, json_path):
+    # Runs in a worker process: parse one slice of pages with pdf2docx and
+    # serialize the layout so the parent can assemble a single docx
+    cv = Converter(pdf_path)
+    try:
+        cv.parse(pages=page_indexes, **cv.default_settings).serialize(json_path)
+    finally:
+        cv.close()
+    return json_path
+
+
+def _pdf_to_docx(pdf_path, docx_path, engine="auto"):
+    # LibreOffice's PDF import is native and much faster; pdf2docx is slower but
+    # rebuilds tables and flowing text better, so callers can ask for it
+    work_dir = os.path.dirname(docx_path)
+    if engine != "pdf2docx" and SOFFICE_BIN:
+        try:
+            out_path = _soffice_convert(pdf_path, work_dir, "docx", infilter="writer_pdf_import")
+            os.replace(out_path, docx_path)
+            return docx_path
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
+            app.logger.warning("LibreOffice PDF import failed, falling back to pdf2docx")
+    cv = Converter(pdf_path)
+    try:
+        # Layout analysis is pure Python and per page: parse contiguous slices in
+        # a process pool, then restore them here and write the docx once. Even a
+        # single slice goes to the pool so it doesn't hold the web worker's GIL.
+        page_count = len(cv.fitz_doc)
+        n_workers = min(os.cpu_count() or 1, page_count)
+        if n_workers:
+            bounds = [page_count * k // n_workers for k in range(n_workers + 1)]
+            slices = [list(range(a, b)) for a, b in zip(bounds, bounds[1:])]
+            json_paths = [os.path.join(work_dir, f"pages_{k}.json") for k in range(n_workers)]
+            with ProcessPoolExecutor(max_workers=n_workers) as ex:
+                for json_path in ex.map(_parse_docx_pages, repeat(pdf_path), slices, json_paths):
+                    cv.deserialize(json_path)
+            cv.make_docx(docx_path, **cv.default_settings)
+        else:
+            cv.convert(docx_path, start=0, end=None)
+    finally:
+        cv.close()
+    return docx_path
+
+
+def _sweep_jobs():
+    now = datetime.now().timestamp()
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def _proc_started(pid):
+    # Start time of pid in clock ticks since boot (Linux only), so a recycled
+    # pid isn't mistaken for the worker that owns a job
+    try:
+        with open(f"/proc/{pid}/stat") as fh:
+            return fh.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _job_owner_alive(owner):
+    pid, started = owner
+    if started is not None:
+        return _proc_started(pid) == started
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _run_job(job_dir, fn, in_path, filename):
+    # The result is renamed into place, so a poll never sees a partial file
+    work_dir = os.path.join(job_dir, "work")
+    os.mkdir(work_dir)
+    try:
+        out_path = fn(in_path, os.path.join(work_dir, filename))
+        os.replace(out_path, os.path.join(job_dir, filename))
+    except Exception as e:
+        app.logger.exception("job %s failed", os.path.basename(job_dir))
+        with open(os.path.join(job_dir, "error"), "w") as fh:
+            fh.write(type(e).__name__)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _start_job(fn, f, in_name, filename, mimetype):
+    # Queue fn(in_path, out_path) on job_pool and answer 202 with the job id
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    _sweep_jobs()
+    job_id = str(uuid.uuid4())
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    os.mkdir(job_dir)
+    in_path = os.path.join(job_dir, in_name)
+    _link_upload(f, in_path)
+    with open(os.path.join(job_dir, "job.json"), "w") as fh:
+        # The job runs on a thread of this worker; if the worker dies, polls report it failed
+        owner = [os.getpid(), _proc_started(os.getpid())]
+        json.dump({"filename": filename, "mimetype": mimetype, "owner": owner}, fh)
+    job_pool.submit(_run_job, job_dir, fn, in_path, filename)
+    return {"job_id": job_id, "status": "running"}, 202
+
+
+def _number_stamps(boxes):
+    # One stamp page per number, each a single hand-written text object, sized
+    # to the target page's trim box so add_overlay places it 1:1
+    stamps = pikepdf.Pdf.new()
+    font = stamps.make_indirect(pikepdf.Dictionary(Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Helvetica))
+    for i, box in enumerate(boxes):
+        x, y = box.urx - NUMBER_OFFSET[0], box.lly + NUMBER_OFFSET[1]
+        page = stamps.add_blank_page()
+        page.MediaBox = box.as_array()
+        page.Resources.Font = pikepdf.Dictionary(F1=font)
+        page.Contents = pikepdf.Stream(stamps, f"BT /F1 {NUMBER_FONT_SIZE} Tf {x:.2f} {y:.2f} Td ({i + 1}) Tj ET".encode())
+    return stamps
+
+
+def _render_pages(pdf_path, zoom, gray, annots, page_indexes):
+    # Runs in a worker process; MuPDF documents can't cross process
+    # boundaries, so every task opens its own handle for a batch of pages.
+    # Pages come back as encoded JPEG bytes, never touching the disk.
+    images = []
+    with fitz.open(pdf_path) as doc:
+        for i in page_indexes:
+            page = doc[i]
+            z = min(zoom, (MAX_RENDER_PIXELS / max(page.rect.width * page.rect.height, 1)) ** 0.5)
+            try:
+                pix = page.get_pixmap(matrix=fitz.Matrix(z, z), colorspace=fitz.csGRAY if gray else fitz.csRGB,
+                                      alpha=False, annots=annots)
+                images.append((f"page_{i+1}.jpg", pix.tobytes("jpeg", jpg_quality=JPG_QUALITY)))
+            except fitz.mupdf.FzErrorBase as e:
+                # MuPDF's exceptions wrap SWIG objects and can't be pickled back to the parent
+                raise RuntimeError(f"page {i + 1}: {e}") from None
+            pix = None
+    # Decoded images and fonts stay in MuPDF's store after the document closes.
+    # Drop them per batch so a pool process working through a long document
+    # doesn't keep a scanned PDF's worth of bitmaps resident.
+    fitz.TOOLS.store_shrink(100)
+    fitz.TOOLS.glyph_cache_empty()
+    return images
 
 
 @app.route("/api/health")
@@ -42,154 +603,213 @@ def health():
     return {"status": "ok", "time": datetime.utcnow().isoformat()}
 
 
+@app.route("/api/jobs/<uuid:job_id>")  # status of an ?async=1 conversion
+def job_status(job_id):
+    _sweep_jobs()
+    job_dir = os.path.join(JOBS_DIR, str(job_id))
+    error_path = os.path.join(job_dir, "error")
+    try:
+        with open(os.path.join(job_dir, "job.json")) as fh:
+            meta = json.load(fh)
+    except FileNotFoundError:
+        return ("Unknown job", 404)
+    if os.path.exists(os.path.join(job_dir, meta["filename"])):
+        return {"job_id": str(job_id), "status": "done", "result": url_for("job_result", job_id=job_id)}
+    if not os.path.exists(error_path) and not _job_owner_alive(meta["owner"]):
+        # Worker was killed or restarted mid-job; nothing will ever finish it
+        with open(error_path, "w") as fh:
+            fh.write("WorkerLost")
+    if os.path.exists(error_path):
+        return {"job_id": str(job_id), "status": "failed"}
+    return {"job_id": str(job_id), "status": "running"}
+
+
+@app.route("/api/jobs/<uuid:job_id>/result")  # download a finished job, then forget it
+def job_result(job_id):
+    job_dir = os.path.join(JOBS_DIR, str(job_id))
+    try:
+        with open(os.path.join(job_dir, "job.json")) as fh:
+            meta = json.load(fh)
+    except FileNotFoundError:
+        return ("Unknown job", 404)
+    out_path = os.path.join(job_dir, meta["filename"])
+    if not os.path.exists(out_path):
+        return ("Job not finished", 409)
+
+    @after_this_request
+    def _cleanup(response):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return response
+
+    return _send_path(out_path, meta["filename"], meta["mimetype"])
+
+
 @app.route("/api/merge", methods=["POST"])  # files[] -> merged.pdf
 def merge_pdf():
     files = request.files.getlist("files")
     if not files:
         return ("No files uploaded", 400)
-    writer = PdfWriter()
-    for f in files:
-        if not _is_type(f, ALLOWED_PDF):
-            return (f"Invalid file type: {f.filename}", 400)
-        reader = PdfReader(f)
-        for p in reader.pages:
-            writer.add_page(p)
-    out = io.BytesIO()
-    writer.write(out)
-    writer.close()
-    out.seek(0)
-    return send_file(out, as_attachment=True, download_name="merged.pdf", mimetype="application/pdf")
+    td = _job_dir()
+    with ExitStack() as stack:
+        in_paths, keys = [], []
+        for i, f in enumerate(files):
+            if not _is_pdf(f):
+                return (f"Invalid file type: {f.filename}", 400)
+            in_path = os.path.join(td, f"in_{i}.pdf")
+            keys.append(_save_upload(f, in_path))
+            in_paths.append(in_path)
+        # Parse the inputs concurrently, then append their pages in upload order.
+        # Sources stay checked out until the merged file is saved: QPDF copies their streams lazily
+        with ThreadPoolExecutor(max_workers=min(8, len(in_paths))) as ex:
+            futures = [ex.submit(_checkout_pdf, p, k) for p, k in zip(in_paths, keys)]
+        sources = []
+        try:
+            for key, fut in zip(keys, futures):
+                sources.append(stack.enter_context(_checked_out(key, fut.result())))
+        except Exception:
+            # One input didn't parse: the stack closes those already entered; close
+            # the ones after it that parsed fine but were never entered
+            for fut in futures[len(sources) + 1:]:
+                if fut.exception() is None:
+                    fut.result().close()
+            raise
+        out = stack.enter_context(pikepdf.Pdf.new())
+        for src in sources:
+            out.pages.extend(src.pages)
+        out_path = os.path.join(td, "merged.pdf")
+        _save_pdf(out, out_path)
+        return _send_path(out_path, "merged.pdf", "application/pdf")
 
 
 @app.route("/api/split", methods=["POST"])  # file + pages (e.g., 1-3,5)
 def split_pdf():
     f = request.files.get("file")
     pages = request.form.get("pages", "").strip()
-    if not f or not _is_type(f, ALLOWED_PDF):
+    if not f or not _is_pdf(f):
         return ("PDF required", 400)
-    reader = PdfReader(f)
-
-    def parse_ranges(spec, maxn):
-        sel = set()
-        for part in spec.replace(" ", "").split(","):
-            if not part:
-                continue
-            if "-" in part:
-                a, b = part.split("-", 1)
-                a = int(a); b = int(b)
-                for i in range(max(1, a), min(maxn, b) + 1):
-                    sel.add(i)
-            else:
-                sel.add(int(part))
-        return sorted(i for i in sel if 1 <= i <= maxn)
-
-    selected = parse_ranges(pages or f"1-{len(reader.pages)}", len(reader.pages))
-    writer = PdfWriter()
-    for i in selected:
-        writer.add_page(reader.pages[i - 1])
-    out = io.BytesIO()
-    writer.write(out)
-    writer.close()
-    out.seek(0)
-    return send_file(out, as_attachment=True, download_name="split.pdf", mimetype="application/pdf")
+    td = _job_dir()
+    in_path = os.path.join(td, "in.pdf")
+    out_path = os.path.join(td, "split.pdf")
+    key = _save_upload(f, in_path)
+    with _cached_pdf(in_path, key) as src, pikepdf.Pdf.new() as out:
+        # Copy each selected interval as one slice
+        for lo, hi in _parse_ranges(pages or f"1-{len(src.pages)}", len(src.pages)):
+            out.pages.extend(src.pages[lo - 1:hi])
+        _save_pdf(out, out_path)
+    return _send_path(out_path, "split.pdf", "application/pdf")
 
 
 @app.route("/api/compress", methods=["POST"])  # file + level (screen|ebook|printer)
 def compress_pdf():
     f = request.files.get("file")
     preset = request.form.get("level", "ebook")
-    if not f or not _is_type(f, ALLOWED_PDF):
+    if not f or not _is_pdf(f):
         return ("PDF required", 400)
 
-    # Try Ghostscript if available for stronger compression
-    try:
-        with tempfile.TemporaryDirectory() as td:
-            inp = os.path.join(td, secure_filename(f.filename) or "input.pdf")
-            outp = os.path.join(td, "compressed.pdf")
-            f.save(inp)
-            gs_preset = {"screen": "/screen", "ebook": "/ebook", "printer": "/printer"}.get(preset, "/ebook")
-            cmd = [
-                "gs", "-sDEVICE=pdfwrite", "-dCompatibilityLevel=1.5",
-                f"-dPDFSETTINGS={gs_preset}", "-dNOPAUSE", "-dQUIET", "-dBATCH",
-                f"-sOutputFile={outp}", inp
-            ]
-            subprocess.check_call(cmd)
-            with open(outp, "rb") as fh:
-                data = fh.read()
-            return _send_bytes(data, "compressed.pdf", "application/pdf")
-    except Exception:
-        pass
+    td = _job_dir()
+    inp = os.path.join(td, "input.pdf")
+    outp = os.path.join(td, "compressed.pdf")
+    key = _save_upload(f, inp)
 
-    # Fallback using pikepdf optimization
-    with tempfile.TemporaryDirectory() as td:
-        inp = os.path.join(td, "in.pdf")
-        outp = os.path.join(td, "out.pdf")
-        f.save(inp)
-        with pikepdf.open(inp) as pdf:
-            pdf.save(outp, optimize_version=True)
-        with open(outp, "rb") as fh:
-            data = fh.read()
-        return _send_bytes(data, "compressed.pdf", "application/pdf")
+    # Ghostscript compresses harder when it's installed; if it rejects the file,
+    # log why and let pikepdf have a go
+    if GS_BIN and key[1] >= GS_MIN_BYTES:
+        try:
+            gs_pool.submit(_run_gs, inp, outp, preset).result()
+            return _send_path(outp, "compressed.pdf", "application/pdf")
+        except subprocess.CalledProcessError as e:
+            app.logger.warning("gs failed (exit %s), falling back to pikepdf", e.returncode)
+
+    # Fallback: let QPDF compress any unfiltered streams, re-deflate existing
+    # Flate streams (images included) at its own level and pack objects into streams
+    with _cached_pdf(inp, key) as pdf:
+        _save_pdf(pdf, outp, compress_streams=True, recompress_flate=True, deterministic_id=True)
+    return _send_path(outp, "compressed.pdf", "application/pdf")
 
 
-@app.route("/api/pdf-to-word", methods=["POST"])  # file -> .docx
+@app.route("/api/pdf-to-word", methods=["POST"])  # file -> .docx (engine=pdf2docx optional)
 def pdf_to_word():
     f = request.files.get("file")
-    if not f or not _is_type(f, ALLOWED_PDF):
+    if not f or not _is_pdf(f):
         return ("PDF required", 400)
-    with tempfile.TemporaryDirectory() as td:
-        pdf_path = os.path.join(td, "input.pdf")
-        docx_path = os.path.join(td, "converted.docx")
-        f.save(pdf_path)
-        cv = Converter(pdf_path)
-        cv.convert(docx_path, start=0, end=None)
-        cv.close()
-        return send_file(docx_path, as_attachment=True, download_name="converted.docx")
+    convert = functools.partial(_pdf_to_docx, engine=request.form.get("engine", "auto"))
+    if request.args.get("async") == "1":
+        return _start_job(convert, f, "input.pdf", "converted.docx", DOCX_MIME)
+    td = _job_dir()
+    pdf_path = os.path.join(td, "input.pdf")
+    _link_upload(f, pdf_path)
+    docx_path = convert(pdf_path, os.path.join(td, "converted.docx"))
+    return _send_path(docx_path, "converted.docx", DOCX_MIME)
 
 
 @app.route("/api/word-to-pdf", methods=["POST"])  # .docx -> .pdf via LibreOffice headless
 def word_to_pdf():
     f = request.files.get("file")
-    if not f or not _is_type(f, ALLOWED_DOC):
+    if not f or not _is_docx(f):
         return ("DOCX required", 400)
-    with tempfile.TemporaryDirectory() as td:
-        in_path = os.path.join(td, secure_filename(f.filename) or "input.docx")
-        out_dir = td
-        f.save(in_path)
-        try:
-            subprocess.check_call(["soffice", "--headless", "--convert-to", "pdf", "--outdir", out_dir, in_path])
-        except FileNotFoundError:
-            return ("LibreOffice not available on server. Use Dockerfile provided.", 500)
-        base = os.path.splitext(os.path.basename(in_path))[0] + ".pdf"
-        out_path = os.path.join(out_dir, base)
-        return send_file(out_path, as_attachment=True, download_name="converted.pdf")
+    if not SOFFICE_BIN:
+        return ("LibreOffice not available on server. Use Dockerfile provided.", 500)
+    td = _job_dir()
+    in_path = os.path.join(td, secure_filename(f.filename) or "input.docx")
+    _link_upload(f, in_path)
+    out_path = _soffice_convert(in_path, td, "pdf")
+    return _send_path(out_path, "converted.pdf", "application/pdf")
 
 
-@app.route("/api/pdf-to-jpg", methods=["POST"])  # file -> zip of jpgs (dpi optional)
+@app.route("/api/pdf-to-jpg", methods=["POST"])  # file -> zip of jpgs (dpi, gray, annots optional)
 def pdf_to_jpg():
     f = request.files.get("file")
-    dpi = int(request.form.get("dpi", 150))
-    if not f or not _is_type(f, ALLOWED_PDF):
+    # Validate everything up front: once the zip starts streaming, the 200 has been sent
+    try:
+        dpi = int(request.form.get("dpi", 150))
+    except ValueError:
+        dpi = 0
+    if dpi <= 0:
+        return ("dpi must be a positive integer", 400)
+    # Grayscale pixmaps are a third the size of RGB and encode about twice as fast
+    gray = request.form.get("gray") == "1"
+    annots = request.form.get("annots", "1") != "0"
+    if not f or not _is_pdf(f):
         return ("PDF required", 400)
-    with tempfile.TemporaryDirectory() as td:
+    # The zip is produced while the response streams, so the job directory has
+    # to outlive this view; the response removes it once it's closed
+    td = tempfile.mkdtemp(prefix="pdfjob-")
+    try:
         pdf_path = os.path.join(td, "in.pdf")
-        f.save(pdf_path)
-        doc = fitz.open(pdf_path)
-        img_paths = []
-        for i, page in enumerate(doc):
-            zoom = dpi / 72.0
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat, alpha=False)
-            outp = os.path.join(td, f"page_{i+1}.jpg")
-            pix.save(outp)
-            img_paths.append(outp)
-        # Zip them
-        zip_bytes = io.BytesIO()
-        with zipfile.ZipFile(zip_bytes, "w", zipfile.ZIP_DEFLATED) as zf:
-            for p in img_paths:
-                zf.write(p, arcname=os.path.basename(p))
-        zip_bytes.seek(0)
-        return send_file(zip_bytes, as_attachment=True, download_name="images.zip", mimetype="application/zip")
+        _link_upload(f, pdf_path)
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+    except Exception:
+        shutil.rmtree(td, ignore_errors=True)
+        raise
+    zoom = dpi / 72.0
+    # Rasterizing is CPU-bound and independent per page: fan out batches of up to
+    # RENDER_BATCH pages over a process pool, so each task amortizes its fitz.open
+    cpus = os.cpu_count() or 1
+    size = max(1, min(RENDER_BATCH, -(-page_count // cpus)))
+    batches = [range(a, min(a + size, page_count)) for a in range(0, page_count, size)]
+    n_workers = min(cpus, len(batches))
+
+    def generate():
+        sink = _ZipSink()
+        # Always render in a pool, even with one process: PyMuPDF holds the GIL,
+        # so rendering inline would stall every other thread of this worker
+        with ProcessPoolExecutor(max(1, n_workers)) as ex:
+            # The sink can't seek, so every entry ends in a data descriptor; streaming
+            # unzippers only accept those on deflated entries. Level 1 keeps that cheap.
+            with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+                # Batches arrive in page order as soon as they're done; each entry is
+                # sent as soon as it's zipped, so nothing accumulates in memory
+                for images in _bounded_map(ex, _render_pages, batches, n_workers * 2, pdf_path, zoom, gray, annots):
+                    for name, data in images:
+                        zf.writestr(name, data)
+                        yield sink.drain()
+        yield sink.drain()
+
+    resp = Response(generate(), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = "attachment; filename=images.zip"
+    resp.call_on_close(lambda: shutil.rmtree(td, ignore_errors=True))
+    return resp
 
 
 @app.route("/api/jpg-to-pdf", methods=["POST"])  # files[] -> single pdf
@@ -197,89 +817,74 @@ def jpg_to_pdf():
     files = request.files.getlist("files")
     if not files:
         return ("No images uploaded", 400)
-    with tempfile.TemporaryDirectory() as td:
-        image_paths = []
+    td = _job_dir()
+    with pikepdf.Pdf.new() as pdf:
         for f in files:
-            if not _is_type(f, ALLOWED_IMG):
+            if not _is_jpeg(f):
                 return (f"Invalid image: {f.filename}", 400)
-            p = os.path.join(td, secure_filename(f.filename) or f"img_{len(image_paths)}.jpg")
-            f.save(p)
-            image_paths.append(p)
-        pdf_bytes = img2pdf.convert(image_paths)
-        return _send_bytes(pdf_bytes, "converted.pdf", "application/pdf")
+            # The bitstream is embedded unchanged, so read it straight from the spooled upload
+            try:
+                _add_jpeg_page(pdf, f.stream.read())
+            except (ValueError, IndexError):
+                return (f"Invalid image: {f.filename}", 400)
+        out_path = os.path.join(td, "converted.pdf")
+        _save_pdf(pdf, out_path)
+        return _send_path(out_path, "converted.pdf", "application/pdf")
 
 
 @app.route("/api/protect", methods=["POST"])  # file + password
 def protect_pdf():
     f = request.files.get("file")
     pwd = request.form.get("password", "").strip()
-    if not f or not _is_type(f, ALLOWED_PDF) or not pwd:
+    if not f or not _is_pdf(f) or not pwd:
         return ("PDF and password required", 400)
-    reader = PdfReader(f)
-    writer = PdfWriter()
-    for p in reader.pages:
-        writer.add_page(p)
-    writer.encrypt(pwd)
-    out = io.BytesIO()
-    writer.write(out)
-    writer.close()
-    out.seek(0)
-    return send_file(out, as_attachment=True, download_name="protected.pdf", mimetype="application/pdf")
+    td = _job_dir()
+    in_path = os.path.join(td, "in.pdf")
+    out_path = os.path.join(td, "protected.pdf")
+    key = _save_upload(f, in_path)
+    # R=6 is AES-256, done natively by QPDF
+    with _cached_pdf(in_path, key) as pdf:
+        _save_pdf(pdf, out_path, encryption=pikepdf.Encryption(owner=pwd, user=pwd, R=6))
+    return _send_path(out_path, "protected.pdf", "application/pdf")
 
 
 @app.route("/api/unlock", methods=["POST"])  # file + password
 def unlock_pdf():
     f = request.files.get("file")
     pwd = request.form.get("password", "").strip()
-    if not f or not _is_type(f, ALLOWED_PDF) or not pwd:
+    if not f or not _is_pdf(f) or not pwd:
         return ("PDF and password required", 400)
-    reader = PdfReader(f)
-    if reader.is_encrypted:
-        if not reader.decrypt(pwd):
-            return ("Incorrect password", 401)
-    writer = PdfWriter()
-    for p in reader.pages:
-        writer.add_page(p)
-    out = io.BytesIO()
-    writer.write(out)
-    writer.close()
-    out.seek(0)
-    return send_file(out, as_attachment=True, download_name="unlocked.pdf", mimetype="application/pdf")
+    td = _job_dir()
+    in_path = os.path.join(td, "in.pdf")
+    out_path = os.path.join(td, "unlocked.pdf")
+    _link_upload(f, in_path)
+    try:
+        pdf = pikepdf.open(in_path, password=pwd)
+    except pikepdf.PasswordError:
+        return ("Incorrect password", 401)
+    # Saving without an encryption argument writes the document decrypted
+    with pdf:
+        _save_pdf(pdf, out_path)
+    return _send_path(out_path, "unlocked.pdf", "application/pdf")
 
 
 @app.route("/api/page-number", methods=["POST"])  # file -> add numbers bottom-right
 def add_page_numbers():
     f = request.files.get("file")
-    if not f or not _is_type(f, ALLOWED_PDF):
+    if not f or not _is_pdf(f):
         return ("PDF required", 400)
-    with tempfile.TemporaryDirectory() as td:
-        in_path = os.path.join(td, "in.pdf")
-        f.save(in_path)
-        reader = PdfReader(in_path)
-        # Create a temp PDF with numbers per page and merge
-        numbered_paths = []
-        for i in range(len(reader.pages)):
-            num_pdf = os.path.join(td, f"num_{i}.pdf")
-            c = canvas.Canvas(num_pdf, pagesize=letter)
-            w, h = letter
-            c.setFont("Helvetica", 10)
-            c.drawString(w - 0.8*inch, 0.5*inch, str(i + 1))
-            c.showPage()
-            c.save()
-            numbered_paths.append(num_pdf)
-        # Merge overlays (sizes assume letter; for varied sizes this is a simple implementation)
-        writer = PdfWriter()
-        for idx, page in enumerate(reader.pages):
-            # Read stamp
-            stamp_reader = PdfReader(numbered_paths[idx])
-            page.merge_page(stamp_reader.pages[0])
-            writer.add_page(page)
-        out = io.BytesIO()
-        writer.write(out)
-        writer.close()
-        out.seek(0)
-        return send_file(out, as_attachment=True, download_name="numbered.pdf", mimetype="application/pdf")
+    td = _job_dir()
+    in_path = os.path.join(td, "in.pdf")
+    _link_upload(f, in_path)
+    out_path = os.path.join(td, "numbered.pdf")
+    with pikepdf.open(in_path) as pdf, _number_stamps([pikepdf.Rectangle(p.trimbox) for p in pdf.pages]) as stamps:
+        # add_overlay places each stamp as a Form XObject over the page's trim box
+        for page, stamp in zip(pdf.pages, stamps.pages):
+            page.add_overlay(stamp)
+        _save_pdf(pdf, out_path)
+    return _send_path(out_path, "numbered.pdf", "application/pdf")
 
 
 if __name__ == "__main__":
+    # Local development only; deployments run under gunicorn (see Procfile/Dockerfile)
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,32 @@
+# Shared by the Dockerfile and the Procfile; gunicorn loads ./gunicorn.conf.py by default.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# gthread workers overlap uploads, downloads and Ghostscript/LibreOffice subprocess
+# waits. PyMuPDF and pdf2docx hold the GIL, so app.py runs rendering and layout
+# analysis in process pools rather than on these threads. Each worker also keeps
+# its own LibreOffice and parsed-PDF cache, so scale processes with WEB_CONCURRENCY
+# and concurrency with threads.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Import PyMuPDF, pikepdf and pdf2docx once in the master and share them copy-on-write
+preload_app = True
+
+# Synchronous pdf-to-word on long documents can take minutes
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))
+
+
+def post_fork(server, worker):
+    # Launch this worker's unoserver now; it takes ~10s to start listening, and
+    # until then conversions fall back to a one-shot soffice
+    import app
+    app._ensure_soffice()
+
+
+def child_exit(server, worker):
+    # Runs in the master, so it also covers workers SIGKILLed on timeout
+    import app
+    app._kill_soffice(worker.pid)